@@ -1,31 +1,95 @@
-from arcpy import AddMessage
+from arcpy import AddMessage, AddWarning
 import requests
 from os import path
+from shutil import disk_usage, rmtree
 from zipfile import ZipFile
 try:
-    from ujson import loads
+    from ujson import loads, dumps
 except:
-    from json import loads
+    from json import loads, dumps
 import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
-def read_api_key():
+# Base URLs of the OneAtlas services, settings can point them at a local stand-in for testing
+api_urls = {'authenticate': 'https://authenticate.foundation.api.oneatlas.airbus.com',
+            'data': 'https://data.api.oneatlas.airbus.com',
+            'search': 'https://search.foundation.api.oneatlas.airbus.com'}
+
+# Shared between download threads: access tokens per API key, bytes reserved in the staging budget
+# for the files and folders still being written, and the pacing state of the global bandwidth budget (max_bandwidth in bytes per second, 0 is unlimited)
+token_cache = {}
+staging_condition = threading.Condition()
+reserved_space = 0
+staging_in_flight = set()
+bandwidth_lock = threading.Lock()
+bandwidth_next = 0.0
+max_bandwidth = 0
+
+def read_settings():
     with open(path.abspath(path.join(path.dirname(__file__), '..', 'arcgis', 'settings.json')), 'r') as settings_file:
-        data = settings_file.read()
-    obj = loads(data)
-    api_key = str(obj['apikey'])
-    settings_file.close()
-    return api_key
+        return loads(settings_file.read())
+
+def read_api_key():
+    settings = read_settings()
+    if settings.get('accounts'):
+        return str(settings['accounts'][0]['apikey'])
+    return str(settings['apikey'])
+
+def read_accounts(download_dir):
+    # Each account downloads into its own subfolder; a plain apikey setting is a single account in download_dir
+    settings = read_settings()
+    accounts = []
+    for account in settings.get('accounts') or [{'apikey': settings['apikey']}]:
+        account_dir = path.abspath(path.join(download_dir, str(account.get('download_subdir', ''))))
+        if not path.isdir(account_dir):
+            os.makedirs(account_dir, exist_ok=True)
+        accounts.append({'apikey': str(account['apikey']), 'download_dir': account_dir})
+    return accounts
+
+def read_connection_settings():
+    # Budgets shared by all accounts: concurrent downloads and total bandwidth (0 means unlimited)
+    settings = read_settings()
+    max_connections = max(1, int(settings.get('max_connections', 1)))
+    max_bandwidth = int(float(settings.get('max_bandwidth_mbps', 0)) * 1000 ** 2 / 8)
+    return max_connections, max_bandwidth
+
+def read_staging_settings():
+    # staging_budget_gb of 0 (or missing) means only the free disk space limits staging;
+    # the budget is tracked by this process alone, so workers sharing a download root cannot use it
+    settings = read_settings()
+    staging_budget = int(float(settings.get('staging_budget_gb', 0)) * 1024 ** 3)
+    evict_extractions = str(settings.get('evict_extractions', False)).lower() == 'true'
+    return staging_budget, evict_extractions
+
+def read_api_urls():
+    urls = dict(api_urls)
+    urls.update(read_settings().get('api_urls') or {})
+    return urls
+
+def read_claim_settings():
+    # claim_lease_seconds of 0 (or missing) means this worker harvests the whole workspace alone
+    return int(read_settings().get('claim_lease_seconds', 0))
 
 def get_token(user_api_key):
-    url = 'https://authenticate.foundation.api.oneatlas.airbus.com/auth/realms/IDP/protocol/openid-connect/token'
+    cached_token = token_cache.get(user_api_key)
+    if cached_token and cached_token[1] > time.time():
+        return cached_token[0]
+    url = api_urls['authenticate'] + '/auth/realms/IDP/protocol/openid-connect/token'
     payload='client_id=IDP&grant_type=api_key&apikey=' + user_api_key
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     response = requests.request('POST', url, headers=headers, data=payload)
     # TODO try except on HTTP403 (stale apikey)
-    return loads(response.text)['access_token']
+    token = loads(response.text)
+    # Refresh a minute early so a token never expires between a request being built and sent
+    token_cache[user_api_key] = (token['access_token'], time.time() + int(token.get('expires_in', 0)) - 60)
+    return token['access_token']
 
 def get_workspace_id(auth_header):
-    url = 'https://data.api.oneatlas.airbus.com/api/v1/me'
+    url = api_urls['data'] + '/api/v1/me'
     payload={}
     headers = {'Authorization': auth_header}
     my_info = requests.request('GET', url, headers=headers, data=payload)
@@ -33,7 +97,7 @@ def get_workspace_id(auth_header):
 
 # Get products available in the My Data workspace
 def get_products_in_workspace(auth_header, workspace_id):
-    url = 'https://search.foundation.api.oneatlas.airbus.com/api/v1/opensearch'
+    url = api_urls['search'] + '/api/v1/opensearch'
     headers = {'Authorization': auth_header}
     querystring = {"itemsPerPage":100, "startPage":1, "sortBy": "-publicationDate", "workspace": workspace_id}
     headers = {'Cache-Control': 'no-cache','Authorization': auth_header, 'Content-Type': 'application/json'}
@@ -46,7 +110,7 @@ def get_products_in_workspace(auth_header, workspace_id):
     return products
 
 def get_product_info(workspace_id, selected_product, auth_header):
-    url = 'https://search.foundation.api.oneatlas.airbus.com/api/v1/opensearch'
+    url = api_urls['search'] + '/api/v1/opensearch'
     querystring = {"workspaceid":workspace_id, "id":selected_product}
     headers = {'Cache-Control': 'no-cache','Authorization': auth_header, 'Content-Type': 'application/json'}
     response = requests.request('GET', url, headers=headers, params=querystring)
@@ -55,21 +119,160 @@ def get_product_info(workspace_id, selected_product, auth_header):
         product_resource_id = feature['_links']['download'][1]['resourceId']
     return product_href, product_resource_id
 
-def download_product_stream(href, filename):
+def list_account_products(account):
+    account_auth_header = 'Bearer ' + get_token(account['apikey'])
+    return get_products_in_workspace(account_auth_header, get_workspace_id(account_auth_header))
+
+def get_products_in_accounts(accounts, max_connections):
+    # List all workspaces concurrently and keep each product id only for the first account that has it
+    with ThreadPoolExecutor(max_workers=max_connections) as pool:
+        listings = list(pool.map(list_account_products, accounts))
+    products = []
+    product_accounts = {}
+    for account, listing in zip(accounts, listings):
+        for product in listing:
+            product_id = product.split(',')[0]
+            if product_id in product_accounts:
+                AddMessage('Product {} is in more than one workspace, it will only be downloaded once.'.format(product_id))
+                continue
+            product_accounts[product_id] = account
+            products.append(product)
+    return products, product_accounts
+
+def throttle_download(num_bytes):
+    # Pace chunks from every download thread against the global bandwidth budget
+    global bandwidth_next
+    if max_bandwidth <= 0:
+        return
+    with bandwidth_lock:
+        now = time.time()
+        start = max(now, bandwidth_next)
+        bandwidth_next = start + num_bytes / max_bandwidth
+    if start > now:
+        time.sleep(start - now)
+
+class StagingError(Exception):
+    # Raised when a product is skipped to stay within the staging budget, the message says why
+    pass
+
+def download_product_stream(href, filename, product_dir, auth_header):
     AddMessage('Started downloading {0}'.format(filename))
-    global auth_header
     headers = {'Authorization': auth_header}
-    with requests.get(href, stream=True, headers=headers) as r:
-        r.raise_for_status()
-        with open(path.join(download_dir, filename), 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                #if chunk: 
-                f.write(chunk)
+    # Write to a part file of this worker so an interrupted download never looks like a complete
+    # archive, and a worker that lost its lease never writes into the new owner's download
+    part_path = path.join(product_dir, filename + '.part.' + get_worker_id())
+    try:
+        with requests.get(href, stream=True, headers=headers) as r:
+            r.raise_for_status()
+            with open(part_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    # If you have chunk encoded response uncomment if
+                    # and set chunk_size parameter to None.
+                    #if chunk: 
+                    throttle_download(len(chunk))
+                    f.write(chunk)
+    except BaseException:
+        # A failed download must not keep counting against the staging budget
+        if path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, path.join(product_dir, filename))
     AddMessage('Finished downloading {0}'.format(filename))
     return
 
+def get_product_size(href, auth_header):
+    # Ask for the archive size up front so the staging budget can be checked before downloading,
+    # return None if neither the HEAD nor the GET response tells it
+    headers = {'Authorization': auth_header}
+    response = requests.head(href, headers=headers, allow_redirects=True)
+    if response.status_code == 200 and 'Content-Length' in response.headers:
+        return int(response.headers['Content-Length'])
+    # Some download links do not answer HEAD, the GET headers arrive before any of the body is read
+    with requests.get(href, stream=True, headers=headers) as r:
+        if r.status_code == 200 and 'Content-Length' in r.headers:
+            return int(r.headers['Content-Length'])
+    return None
+
+def get_extracted_size(product_resource_id, download_dir):
+    zf = ZipFile(path.join(download_dir, product_resource_id))
+    extracted_size = sum(info.file_size for info in zf.infolist())
+    zf.close()
+    return extracted_size
+
+def get_staged_size(download_dir):
+    # Files still being written are covered by their full reservation, so they are left out here
+    staged_size = 0
+    for root, dirs, files in os.walk(download_dir):
+        # Lock and completion files of the shared claims folder come and go while other workers run
+        if '.claims' in dirs:
+            dirs.remove('.claims')
+        dirs[:] = [d for d in dirs if path.abspath(path.join(root, d)) not in staging_in_flight]
+        for file in files:
+            if path.abspath(path.join(root, file)) in staging_in_flight:
+                continue
+            try:
+                staged_size += path.getsize(path.join(root, file))
+            except FileNotFoundError:
+                pass
+    return staged_size
+
+def get_available_space(staging_dir, staging_budget):
+    available_space = disk_usage(staging_dir).free
+    if staging_budget > 0:
+        available_space = min(available_space, staging_budget - get_staged_size(staging_dir))
+    # Space promised to downloads and extractions still running in other threads
+    return available_space - reserved_space
+
+def reserve_space(required_size, staging_dir, staging_budget, evictable, in_flight_path):
+    # Evict the oldest published extractions until the required size fits, wait while the space is
+    # only held by other staging in flight, return False if it can never fit
+    global reserved_space
+    with staging_condition:
+        while True:
+            # Walking the staging folder is slow on a share, so measure it once per pass
+            available_space = get_available_space(staging_dir, staging_budget)
+            if available_space >= required_size:
+                break
+            if len(evictable) > 0:
+                evicted_path = evictable.pop(0)
+                AddMessage('Evicting published product: ' + evicted_path)
+                rmtree(evicted_path, ignore_errors=True)
+                if path.exists(evicted_path + '.published'):
+                    os.remove(evicted_path + '.published')
+            elif available_space + reserved_space >= required_size:
+                staging_condition.wait()
+            else:
+                AddWarning('Not enough staging space: {} bytes required, {} bytes available in {}'.format(
+                    required_size, available_space, staging_dir))
+                return False
+        reserved_space += required_size
+        staging_in_flight.add(path.abspath(in_flight_path))
+    return True
+
+def release_space(reserved_size, in_flight_path):
+    # The written bytes are now counted by get_staged_size instead
+    global reserved_space
+    with staging_condition:
+        reserved_space -= reserved_size
+        staging_in_flight.discard(path.abspath(in_flight_path))
+        staging_condition.notify_all()
+
+def mark_published(archive_local_path):
+    # Published extractions can be evicted by later runs to make room for new products
+    with open(archive_local_path + '.published', 'w') as published_file:
+        published_file.write(time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def get_published_extractions(download_dir, current_extractions):
+    # Oldest published first, so eviction frees the extractions least likely to be needed again;
+    # the extractions of the products this run stages are never evicted
+    published = []
+    for root, dirs, files in os.walk(download_dir):
+        for file in files:
+            extraction_path = path.abspath(path.join(root, file[:-len('.published')]))
+            if file.endswith('.published') and path.isdir(extraction_path) and extraction_path not in current_extractions:
+                published.append(extraction_path)
+    return sorted(published, key=lambda published_path: path.getmtime(published_path + '.published'))
+
 def extract_product(product_resource_id, download_dir):
     zf = ZipFile(path.join(download_dir, product_resource_id))
     AddMessage('Extracting product archive...')
@@ -80,6 +283,257 @@ def extract_product(product_resource_id, download_dir):
     AddMessage('Product extracted to: ' + archive_local_path)
     return
 
+def verify_extraction(product_resource_id, download_dir):
+    zf = ZipFile(path.join(download_dir, product_resource_id))
+    archive_local_path = path.join(download_dir, path.splitext(product_resource_id)[0])
+    verified = True
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        extracted_file = path.join(archive_local_path, info.filename)
+        if not path.isfile(extracted_file) or path.getsize(extracted_file) != info.file_size:
+            verified = False
+            break
+    zf.close()
+    return verified
+
+def stage_product(href, product_resource_id, product_dir, staging_dir, extract, staging_budget, evictable, auth_header):
+    # Download and optionally extract one product into product_dir within the staging budget
+    # of the whole staging_dir, raise StagingError if it has to be skipped
+    archive_path = path.join(product_dir, product_resource_id)
+    archive_local_path = path.join(product_dir, path.splitext(product_resource_id)[0])
+    if not path.exists(archive_path) and path.isdir(archive_local_path) and staging_budget > 0:
+        # The archive is only removed once its extraction has been verified
+        AddMessage('Product already extracted to {}, skipping download.'.format(archive_local_path))
+        return
+    if not path.exists(archive_path):
+        product_size = get_product_size(href, auth_header)
+        if product_size is None:
+            if staging_budget > 0:
+                raise StagingError('Size of {} is unknown, skipping its download to stay within the staging budget.'.format(product_resource_id))
+            product_size = 0
+        part_path = archive_path + '.part.' + get_worker_id()
+        if not reserve_space(product_size, staging_dir, staging_budget, evictable, part_path):
+            raise StagingError('Not enough staging space to download {}'.format(product_resource_id))
+        try:
+            download_product_stream(href, product_resource_id, product_dir, auth_header)
+        finally:
+            release_space(product_size, part_path)
+    else:
+        AddMessage('File {} already exists, skipping download.'.format(archive_path))
+    if extract == 'true':
+        extracted_size = get_extracted_size(product_resource_id, product_dir)
+        if not reserve_space(extracted_size, staging_dir, staging_budget, evictable, archive_local_path):
+            raise StagingError('Not enough staging space to extract {}'.format(product_resource_id))
+        try:
+            extract_product(product_resource_id, product_dir)
+        finally:
+            release_space(extracted_size, archive_local_path)
+        if staging_budget > 0:
+            if verify_extraction(product_resource_id, product_dir):
+                AddMessage('Extraction verified, removing archive: ' + archive_path)
+                os.remove(archive_path)
+            else:
+                AddWarning('Extraction of {} could not be verified, keeping archive.'.format(product_resource_id))
+    return
+
+def harvest_product(product, account, staging_dir, extract, staging_budget, evictable, claim):
+    # Stage one product with its own account's token, return the extraction path or None if it was skipped
+    product_resource_id = product.split(',')[2]
+    if not claim_held(claim):
+        AddWarning('Lost the claim on {} before staging it, leaving it to the new owner.'.format(product_resource_id))
+        return None
+    account_auth_header = 'Bearer ' + get_token(account['apikey'])
+    try:
+        stage_product(product.split(',')[1], product_resource_id, account['download_dir'], staging_dir, extract, staging_budget, evictable, account_auth_header)
+    except StagingError as e:
+        AddWarning(str(e))
+        return None
+    if not claim_held(claim):
+        AddWarning('Lost the claim on {} while staging it, leaving it to the new owner.'.format(product_resource_id))
+        return None
+    return path.join(account['download_dir'], path.splitext(product_resource_id)[0])
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+def get_share_time(claims_dir, worker_id):
+    # Lease ages are measured against the clock of the share holding the claims folder,
+    # so workers on different hosts do not need synchronized clocks
+    clock_path = path.join(claims_dir, '.clock.' + worker_id)
+    with open(clock_path, 'w'):
+        pass
+    share_time = path.getmtime(clock_path)
+    os.remove(clock_path)
+    return share_time
+
+def owns_claim(lock_path, worker_id):
+    # Other errors than a missing lock are left to the caller, they are usually transient on a share
+    try:
+        with open(lock_path, 'r') as lock_file:
+            return lock_file.read() == worker_id
+    except FileNotFoundError:
+        return False
+
+def claim_held(claim):
+    # Without a lease there is nothing to lose, and a transient share error is not a lost lease
+    if claim is None:
+        return True
+    try:
+        return owns_claim(claim[0], claim[2])
+    except OSError:
+        return True
+
+def heartbeat_claim(lock_path, worker_id, lease_seconds, stop_event):
+    # Keep the lease alive by touching the lock file well inside the expiry window,
+    # retrying sooner after a failed touch until the claim is released or taken over
+    interval = lease_seconds / 3
+    while not stop_event.wait(interval):
+        try:
+            if not owns_claim(lock_path, worker_id):
+                AddWarning('Lost the claim {} to another worker'.format(lock_path))
+                return
+            os.utime(lock_path)
+            interval = lease_seconds / 3
+        except OSError:
+            interval = min(lease_seconds / 3, 5)
+
+def claim_product(product_id, claims_dir, worker_id, lease_seconds):
+    # Atomically create the lock file for a product, taking over leases whose heartbeat has expired
+    lock_path = path.join(claims_dir, product_id + '.lock')
+    done_path = path.join(claims_dir, product_id + '.done')
+    try:
+        # Reading the lock first keeps the probe file of get_share_time for products that are locked
+        lock_mtime = path.getmtime(lock_path)
+        if get_share_time(claims_dir, worker_id) - lock_mtime > lease_seconds:
+            stale_path = lock_path + '.' + worker_id + '.stale'
+            os.rename(lock_path, stale_path)
+            # Another worker may have taken over and written a fresh lock between the age check and the rename
+            if get_share_time(claims_dir, worker_id) - path.getmtime(stale_path) <= lease_seconds:
+                if not path.exists(lock_path):
+                    os.rename(stale_path, lock_path)
+                else:
+                    os.remove(stale_path)
+                return None
+            AddMessage('Taking over expired claim on product {}'.format(product_id))
+            os.remove(stale_path)
+    except OSError:
+        pass
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    os.write(fd, worker_id.encode('utf-8'))
+    os.close(fd)
+    # The previous owner may have finished between the .done check of the scan and the lock
+    if path.exists(done_path):
+        os.remove(lock_path)
+        return None
+    stop_event = threading.Event()
+    threading.Thread(target=heartbeat_claim, args=(lock_path, worker_id, lease_seconds, stop_event), daemon=True).start()
+    return lock_path, stop_event, worker_id
+
+def release_claim(claim):
+    if claim is None:
+        return
+    lock_path, stop_event, worker_id = claim
+    stop_event.set()
+    try:
+        # Never remove a lock that another worker took over after this lease expired
+        if owns_claim(lock_path, worker_id):
+            os.remove(lock_path)
+    except OSError:
+        pass
+
+def complete_claim(claim, archive_local_path, worker_id):
+    # Record completion in the shared claims folder before giving up the lease,
+    # return False if the lease was lost and the product is left to its new owner
+    if claim is None:
+        return True
+    if not claim_held(claim):
+        AddWarning('Lost the claim {} to another worker, not recording it as done.'.format(claim[0]))
+        claim[1].set()
+        return False
+    lock_path = claim[0]
+    done_path = path.splitext(lock_path)[0] + '.done'
+    with open(done_path + '.' + worker_id, 'w') as done_file:
+        done_file.write(dumps({'worker': worker_id, 'path': archive_local_path, 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}))
+    os.replace(done_path + '.' + worker_id, done_path)
+    release_claim(claim)
+    return True
+
+def claim_next_product(products_list, claims_dir, worker_id, lease_seconds, attempted):
+    # One pass over the products without waiting: return (product, claim, 0) for the next product
+    # claimed, or (None, None, waiting) with the number of products other workers still hold
+    waiting = 0
+    for product in products_list:
+        product_id = product.split(',')[0]
+        if product_id in attempted:
+            continue
+        if lease_seconds <= 0:
+            attempted.add(product_id)
+            return product, None, 0
+        if path.exists(path.join(claims_dir, product_id + '.done')):
+            continue
+        claim = claim_product(product_id, claims_dir, worker_id, lease_seconds)
+        if claim is None:
+            waiting += 1
+            continue
+        attempted.add(product_id)
+        return product, claim, 0
+    return None, None, waiting
+
+def harvest_products(products_list, product_accounts, staging_dir, extract, staging_budget, evictable, lease_seconds, max_connections):
+    # Stage products on up to max_connections threads, sharing them with other workers through lease
+    # claims when lease_seconds is set, and return the extraction paths of the products harvested here
+    claims_dir = path.join(staging_dir, '.claims')
+    worker_id = get_worker_id()
+    if lease_seconds > 0:
+        os.makedirs(claims_dir, exist_ok=True)
+        AddMessage('Harvesting as worker {} with a {} second claim lease'.format(worker_id, lease_seconds))
+    harvested = []
+    attempted = set()
+    in_flight = deque()
+    harvest_pool = ThreadPoolExecutor(max_workers=max_connections)
+    while True:
+        # Only claim a product once a connection is free so other workers can take the rest
+        waiting = 0
+        while len(in_flight) < max_connections:
+            product, claim, waiting = claim_next_product(products_list, claims_dir, worker_id, lease_seconds, attempted)
+            if product is None:
+                break
+            AddMessage('Handling product {} of {}'.format(products_list.index(product) + 1, len(products_list)))
+            harvest = harvest_pool.submit(harvest_product, product, product_accounts[product.split(',')[0]], staging_dir, extract, staging_budget, evictable, claim)
+            in_flight.append((product, claim, harvest))
+        if len(in_flight) == 0:
+            if waiting == 0:
+                break
+            # Only sleep once this worker's own harvests are completed, other workers may be waiting on them
+            AddMessage('Waiting on {} product(s) claimed by other workers...'.format(waiting))
+            time.sleep(lease_seconds / 3)
+            continue
+        product, claim, harvest = in_flight.popleft()
+        try:
+            archive_local_path = harvest.result()
+        except Exception:
+            # Let running downloads finish before giving back every claim this worker holds,
+            # so no other worker writes the same files while they are still being written
+            for in_flight_product, in_flight_claim, in_flight_harvest in in_flight:
+                in_flight_harvest.cancel()
+            wait([in_flight_harvest for in_flight_product, in_flight_claim, in_flight_harvest in in_flight])
+            harvest_pool.shutdown()
+            release_claim(claim)
+            for in_flight_product, in_flight_claim, in_flight_harvest in in_flight:
+                release_claim(in_flight_claim)
+            raise
+        if archive_local_path is None:
+            release_claim(claim)
+            continue
+        if complete_claim(claim, archive_local_path, worker_id):
+            harvested.append(archive_local_path)
+    harvest_pool.shutdown()
+    return harvested
+
 def get_product_proc_level(product_folder):
     AddMessage('Seeking DIMAP file(s) in: ' + path.join(download_dir, product_folder))
     from os import walk
@@ -231,6 +685,9 @@ if __name__ == '__main__':
         selected_product = '6bba59e1-4e51-4461-8704-94d7d5c240b9'
         download_dir = r'C:\data\Airbus\OAD\ToolboxTests'
         auth_header = 'Bearer: token'
+        staging_budget, evict_extractions = 0, False
+        lease_seconds = 0
+        max_connections = 1
     else:
         from arcpy import GetParameterAsText
         selected_product = GetParameterAsText(0)
@@ -242,28 +699,41 @@ if __name__ == '__main__':
         layer_type = GetParameterAsText(6)
         make_image_collection = GetParameterAsText(7)
         pansharpen_from_bundle = GetParameterAsText(8)
+        api_urls.update(read_api_urls())
         api_key = read_api_key()
         auth_header = 'Bearer ' + get_token(api_key)
         workspace_id = get_workspace_id(auth_header) 
+        staging_budget, evict_extractions = read_staging_settings()
+        lease_seconds = read_claim_settings()
+        max_connections, max_bandwidth = read_connection_settings()
+        if staging_budget > 0 and lease_seconds > 0:
+            raise RuntimeError('staging_budget_gb is tracked per worker process and cannot be combined with claim_lease_seconds.')
+    # Extractions published by earlier runs that may be deleted to make room for the products of this run
+    evictable = []
 
     if all_products == 'false' or all_products == '':
         selected_product = selected_product.split('=',1)[1]
         AddMessage('Selected Product: ' + selected_product)
         AddMessage('Download Directory: ' + download_dir)
+        # Like its API key, a single product uses the first account's download folder
+        product_dir = read_accounts(download_dir)[0]['download_dir']
         product_href, product_resource_id = get_product_info(workspace_id, selected_product, auth_header)
-        if not path.exists(path.join(download_dir, product_resource_id)):
-            download_product_stream(product_href, product_resource_id)
-        else:
-            AddMessage('File {} already exists, skipping download.'.format(path.join(download_dir, product_resource_id)))
+        if evict_extractions:
+            evictable = get_published_extractions(download_dir, {path.abspath(path.join(product_dir, path.splitext(product_resource_id)[0]))})
+        stage_product(product_href, product_resource_id, product_dir, download_dir, extract, staging_budget, evictable, auth_header)
         if extract == 'true':
-            extract_product(product_resource_id, download_dir)
             # find the DIMAP file in extracted product dir
-            product_proc_level = get_product_proc_level(path.splitext(product_resource_id)[0])
+            product_proc_level = get_product_proc_level(path.join(product_dir, path.splitext(product_resource_id)[0]))
     else:
         AddMessage('All products selected')
         AddMessage('Download Directory: ' + download_dir)
-        products_list = get_products_in_workspace(auth_header, workspace_id)
-        num_products = len(products_list)
+        accounts = read_accounts(download_dir)
+        AddMessage('Listing the workspaces of {} account(s)'.format(len(accounts)))
+        products_list, product_accounts = get_products_in_accounts(accounts, max_connections)
+        if evict_extractions:
+            evictable = get_published_extractions(download_dir, {
+                path.abspath(path.join(product_accounts[product.split(',')[0]]['download_dir'], path.splitext(product.split(',')[2])[0]))
+                for product in products_list})
         phr_bundle_ortho_disp = []
         phr_bundle_ortho_refl = []
         phr_ps_ortho_disp = []
@@ -276,18 +746,9 @@ if __name__ == '__main__':
         spot7_bundle_ortho_refl = []
         spot7_ps_ortho_disp = []
         spot7_ps_ortho_refl = []
-        i = 1
-        for product in products_list:
-            AddMessage('Handling product {} of {}'.format(i, num_products))
-            product_resource_id = product.split(',')[2]
-            archive_base_name = path.splitext(product_resource_id)[0]
-            archive_local_path = path.join(download_dir, archive_base_name)
-            if not path.exists(path.join(download_dir, product_resource_id)):
-                download_product_stream(product.split(',')[1], product_resource_id)
-            else:
-                AddMessage('File {} already exists, skipping download.'.format(path.join(download_dir, product_resource_id)))
+        # Workers sharing this download directory coordinate through lock files in its claims folder
+        for archive_local_path in harvest_products(products_list, product_accounts, download_dir, extract, staging_budget, evictable, lease_seconds, max_connections):
             if extract == 'true':
-                extract_product(product_resource_id, download_dir)
                 # find the DIMAP file in extracted product dir
                 this_product = get_product_proc_level(archive_local_path)
                 if this_product == 'PHR_1A BUNDLE P ORTHO DISPLAY' or this_product == 'PHR_1B BUNDLE P ORTHO DISPLAY': 
@@ -314,7 +775,6 @@ if __name__ == '__main__':
                     spot7_ps_ortho_disp.append(archive_local_path)
                 if this_product == 'SPOT_7 PANSHARPENED PMS ORTHO REFLECTANCE': 
                     spot7_ps_ortho_refl.append(archive_local_path) 
-            i += 1
 
     if publish == 'true':
         if all_products == 'false' or all_products == '': 
@@ -326,7 +786,7 @@ if __name__ == '__main__':
                 if product_proc_level.split()[0] == 'SPOT_7':
                     airbus_raster_type = 'SPOT 7' 
             archive_base_name = path.splitext(product_resource_id)[0]
-            archive_local_path = path.join(download_dir, archive_base_name)
+            archive_local_path = path.join(product_dir, archive_base_name)
             infiles = []
             infiles.append(archive_local_path)
 
@@ -338,6 +798,7 @@ if __name__ == '__main__':
 
         if all_products == 'false' or all_products == '':            
             publish_layer(infiles, airbus_raster_type, product_proc_level, layer_name, layer_type, make_image_collection, pansharpen_from_bundle)
+            mark_published(archive_local_path)
         else:
             #AddMessage('Publishing all products in layer groups...')
             AddMessage('Reporting all layer groups that have content...')
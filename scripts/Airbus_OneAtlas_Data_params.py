@@ -88,7 +88,11 @@ def get_api_key():
     with open(path.abspath(path.join(path.dirname(__file__), 'settings.json')), 'r') as settings_file:
         data = settings_file.read()
     obj = loads(data)
-    key = str(obj['apikey'])
+    # The product list in the tool dialog shows the first configured account
+    if obj.get('accounts'):
+        key = str(obj['accounts'][0]['apikey'])
+    else:
+        key = str(obj['apikey'])
     settings_file.close()        
     return key
 
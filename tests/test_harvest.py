@@ -0,0 +1,243 @@
+"""Tests of the staging budget and of multi-process lease claims in Airbus_OneAtlas_Data, run against a local HTTP stand-in of OneAtlas."""
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# arcpy only exists inside ArcGIS Pro, the harvest only needs its message functions
+if 'arcpy' not in sys.modules:
+    arcpy = types.ModuleType('arcpy')
+    arcpy.AddMessage = arcpy.AddWarning = lambda message: None
+    sys.modules['arcpy'] = arcpy
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+import Airbus_OneAtlas_Data as airbus
+
+PRODUCTS = ['product-{}'.format(i) for i in range(6)]
+
+
+def make_archive(product_id):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('{0}/DIM_{0}.XML'.format(product_id), '<Dimap_Document/>')
+    return archive.getvalue()
+
+
+ARCHIVES = {product_id: make_archive(product_id) for product_id in PRODUCTS}
+
+
+class OneAtlasStandIn(BaseHTTPRequestHandler):
+    # Serves the token, me, opensearch and download endpoints the harvest uses
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_json({'access_token': 'token', 'expires_in': 3600})
+
+    def send_archive(self, with_body):
+        product_id = self.path.rsplit('/', 1)[1][:-len('.zip')]
+        if self.path.startswith('/broken/') and with_body:
+            # The connection drops halfway through the archive
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(ARCHIVES[product_id])))
+            self.end_headers()
+            self.wfile.write(ARCHIVES[product_id][:10])
+            return
+        if product_id not in ARCHIVES:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(ARCHIVES[product_id])))
+        self.end_headers()
+        if with_body:
+            # Slow enough that the workers overlap
+            time.sleep(0.1)
+            self.wfile.write(ARCHIVES[product_id])
+
+    def do_HEAD(self):
+        self.send_archive(False)
+
+    def do_GET(self):
+        if self.path.startswith('/api/v1/me'):
+            self.send_json({'contract': {'workspaceId': 'workspace'}})
+        elif self.path.startswith('/api/v1/opensearch'):
+            base_url = 'http://{}:{}'.format(*self.server.server_address)
+            self.send_json({'features': [
+                {'properties': {'id': product_id},
+                 '_links': {'download': [{}, {'href': base_url + '/files/' + product_id + '.zip',
+                                              'resourceId': product_id + '.zip'}]}}
+                for product_id in PRODUCTS]})
+        else:
+            self.send_archive(True)
+
+
+@pytest.fixture
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OneAtlasStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://{}:{}'.format(*server.server_address)
+    server.shutdown()
+    server.server_close()
+
+
+def harvest(base_url, download_dir, lease_seconds, max_connections):
+    # One worker process running the harvest loop of the tool against the stand-in
+    airbus.api_urls.update({'authenticate': base_url, 'data': base_url, 'search': base_url})
+    account = {'apikey': 'key', 'download_dir': download_dir}
+    products_list, product_accounts = airbus.get_products_in_accounts([account], 1)
+    harvested = airbus.harvest_products(products_list, product_accounts, download_dir, 'true', 0, [], lease_seconds, max_connections)
+    return [os.path.basename(archive_local_path) for archive_local_path in harvested]
+
+
+def run_workers(base_url, download_dir, workers, lease_seconds, max_connections=2):
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        # A deadlock between workers fails the test instead of hanging it
+        return pool.starmap_async(harvest, [(base_url, download_dir, lease_seconds, max_connections)] * workers).get(60)
+
+
+def assert_all_harvested(download_dir):
+    claims_dir = os.path.join(download_dir, '.claims')
+    for product_id in PRODUCTS:
+        with open(os.path.join(claims_dir, product_id + '.done')) as done_file:
+            assert json.load(done_file)['path'] == os.path.join(download_dir, product_id)
+        assert os.path.isfile(os.path.join(download_dir, product_id, product_id, 'DIM_' + product_id + '.XML'))
+    assert [file for file in os.listdir(claims_dir) if not file.endswith('.done')] == []
+
+
+def test_workers_harvest_each_product_once(stand_in, tmp_path):
+    harvested = run_workers(stand_in, str(tmp_path), 3, 5)
+    assert sorted(sum(harvested, [])) == PRODUCTS
+    assert all(len(worker_products) > 0 for worker_products in harvested)
+    assert_all_harvested(str(tmp_path))
+
+
+def test_single_connection_workers_harvest_each_product_once(stand_in, tmp_path):
+    harvested = run_workers(stand_in, str(tmp_path), 2, 5, 1)
+    assert sorted(sum(harvested, [])) == PRODUCTS
+    assert_all_harvested(str(tmp_path))
+
+
+def test_crashed_claim_is_taken_over(stand_in, tmp_path):
+    # A worker crashed while downloading the first product: its lock went stale and its archive is partial
+    claims_dir = tmp_path / '.claims'
+    claims_dir.mkdir()
+    lock_path = claims_dir / (PRODUCTS[0] + '.lock')
+    lock_path.write_text('crashed-worker')
+    os.utime(lock_path, (time.time() - 60, time.time() - 60))
+    (tmp_path / (PRODUCTS[0] + '.zip.part.crashed-worker')).write_bytes(ARCHIVES[PRODUCTS[0]][:10])
+    harvested = run_workers(stand_in, str(tmp_path), 2, 5)
+    assert sorted(sum(harvested, [])) == PRODUCTS
+    assert_all_harvested(str(tmp_path))
+
+
+def test_live_claim_is_not_taken_over(tmp_path):
+    lock_path = tmp_path / (PRODUCTS[0] + '.lock')
+    lock_path.write_text('other-worker')
+    assert airbus.claim_product(PRODUCTS[0], str(tmp_path), 'this-worker', 5) is None
+    assert lock_path.read_text() == 'other-worker'
+
+
+def test_done_product_is_not_claimed(tmp_path):
+    (tmp_path / (PRODUCTS[0] + '.done')).write_text('{}')
+    assert airbus.claim_product(PRODUCTS[0], str(tmp_path), 'this-worker', 5) is None
+    assert not (tmp_path / (PRODUCTS[0] + '.lock')).exists()
+
+
+def test_lost_claim_is_not_completed(tmp_path):
+    claim = airbus.claim_product(PRODUCTS[0], str(tmp_path), 'this-worker', 5)
+    (tmp_path / (PRODUCTS[0] + '.lock')).write_text('other-worker')
+    assert not airbus.complete_claim(claim, str(tmp_path / PRODUCTS[0]), 'this-worker')
+    assert not (tmp_path / (PRODUCTS[0] + '.done')).exists()
+    assert (tmp_path / (PRODUCTS[0] + '.lock')).read_text() == 'other-worker'
+
+
+def test_release_keeps_lock_of_new_owner(tmp_path):
+    claim = airbus.claim_product(PRODUCTS[0], str(tmp_path), 'this-worker', 5)
+    lock_path = tmp_path / (PRODUCTS[0] + '.lock')
+    # The lease expired and another worker took the product over
+    lock_path.write_text('other-worker')
+    airbus.release_claim(claim)
+    assert lock_path.read_text() == 'other-worker'
+
+
+def reserve_in_thread(staging_dir, staging_budget, required_size, in_flight_path):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        airbus.reserve_space(required_size, staging_dir, staging_budget, [], in_flight_path)), daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_download_in_flight_is_not_counted_twice(tmp_path):
+    # Three 10 byte downloads fit a 30 byte budget, even while the first one has written part of its archive
+    part_path = str(tmp_path / 'product-0.zip.part')
+    assert airbus.reserve_space(10, str(tmp_path), 30, [], part_path)
+    with open(part_path, 'wb') as part_file:
+        part_file.write(b'x' * 4)
+    thread, result = reserve_in_thread(str(tmp_path), 30, 10, str(tmp_path / 'product-1.zip.part'))
+    thread.join(5)
+    assert result == [True]
+    assert airbus.reserve_space(10, str(tmp_path), 30, [], str(tmp_path / 'product-2.zip.part'))
+    for i in range(3):
+        airbus.release_space(10, str(tmp_path / 'product-{}.zip.part'.format(i)))
+    assert airbus.reserved_space == 0
+
+
+def test_short_space_waits_for_staging_in_flight(tmp_path):
+    part_path = str(tmp_path / 'product-0.zip.part')
+    assert airbus.reserve_space(20, str(tmp_path), 20, [], part_path)
+    thread, result = reserve_in_thread(str(tmp_path), 20, 10, str(tmp_path / 'product-1.zip.part'))
+    thread.join(0.5)
+    assert thread.is_alive()
+    # The first download failed and left nothing on disk
+    airbus.release_space(20, part_path)
+    thread.join(5)
+    assert result == [True]
+    airbus.release_space(10, str(tmp_path / 'product-1.zip.part'))
+
+
+def test_product_larger_than_budget_is_skipped(tmp_path):
+    assert not airbus.reserve_space(30, str(tmp_path), 20, [], str(tmp_path / 'product-0.zip.part'))
+    assert airbus.reserved_space == 0
+
+
+def test_failed_download_leaves_no_part_file(stand_in, tmp_path):
+    with pytest.raises(Exception):
+        airbus.download_product_stream(stand_in + '/broken/' + PRODUCTS[0] + '.zip', PRODUCTS[0] + '.zip', str(tmp_path), 'Bearer token')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_eviction_skips_current_products_and_removes_markers(tmp_path):
+    for product_id in PRODUCTS[:3]:
+        (tmp_path / product_id).mkdir()
+        (tmp_path / product_id / 'image.tif').write_bytes(b'x' * 10)
+        (tmp_path / (product_id + '.published')).write_text('')
+    current_extraction = os.path.abspath(str(tmp_path / PRODUCTS[2]))
+    evictable = airbus.get_published_extractions(str(tmp_path), {current_extraction})
+    assert current_extraction not in evictable
+    assert len(evictable) == 2
+    # Room for 10 more bytes only appears once one published extraction is evicted
+    assert airbus.reserve_space(10, str(tmp_path), 35, evictable, str(tmp_path / 'product-3.zip.part'))
+    airbus.release_space(10, str(tmp_path / 'product-3.zip.part'))
+    evicted = [product_id for product_id in PRODUCTS[:2] if not (tmp_path / product_id).exists()]
+    assert len(evicted) == 1
+    assert not (tmp_path / (evicted[0] + '.published')).exists()
+    assert (tmp_path / PRODUCTS[2]).is_dir()